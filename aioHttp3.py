@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
-import math
 import asyncio
+from collections import defaultdict
 import aiohttp
+import numpy as np
+import orjson
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 BASE_URL = "http://localhost:5000"
 SIMULATION_CONFIG = {
@@ -10,47 +17,96 @@ SIMULATION_CONFIG = {
     "maxActiveCalls": 1000    # Maximum number of concurrent emergencies to process in one batch
 }
 POLL_TIMEOUT = 2  # seconds to wait for a new call before exiting
+MAX_CONCURRENT_DISPATCHES = 256  # dispatch POSTs allowed in flight at once
+REFRESH_EVERY_DISPATCHES = 100  # dispatches that trigger an early availability refresh
 
-# Global availability cache for all five services and a shared lock.
-availability_cache = {
-    "Medical": {},
-    "Fire": {},
-    "Police": {},
-    "Rescue": {},
-    "Utility": {}
+# Search and dispatch endpoint for each service type.
+SEARCH_ENDPOINTS = {
+    "Medical": "/medical/search",
+    "Fire": "/fire/search",
+    "Police": "/police/search",
+    "Rescue": "/rescue/search",
+    "Utility": "/utility/search"
+}
+ENDPOINTS = {
+    "Medical": "/medical/dispatch",
+    "Fire": "/fire/dispatch",
+    "Police": "/police/dispatch",
+    "Rescue": "/rescue/dispatch",
+    "Utility": "/utility/dispatch"
 }
-cache_lock = asyncio.Lock()
 
-async def call_api(session, endpoint, method="GET", payload=None, params=None):
-    url = f"{BASE_URL}{endpoint}"
+# Global availability cache for all five services. Each snapshot dict is replaced
+# wholesale by the updater and never mutated, so readers can use it without a lock.
+availability_cache = {service: {} for service in SEARCH_ENDPOINTS}
+# Units reserved locally that the current snapshot does not reflect yet;
+# effective availability is snapshot minus pending.
+pending_units = {service: defaultdict(int) for service in SEARCH_ENDPOINTS}
+# Units reserved since the running refresh sent its search requests.
+reserved_since_poll = {service: defaultdict(int) for service in SEARCH_ENDPOINTS}
+# Units whose dispatch POST has not returned yet.
+in_flight_units = {service: defaultdict(int) for service in SEARCH_ENDPOINTS}
+
+# Static city ordering, built once by build_city_index(): nearest[city] is a
+# tuple of every city name sorted by distance from that city, nearest first.
+nearest = {}
+# Pre-encoded JSON fragments of every city's source and target fields, so a
+# dispatch body is assembled by concatenating bytes.
+source_payloads = {}
+target_payloads = {}
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Optional emulator endpoint taking every dispatch of an emergency in one POST.
+# Only enable BULK_DISPATCH for an emulator that serves it; it is never probed,
+# and a failed bulk POST falls back to posting each dispatch on its own.
+BULK_DISPATCH_ENDPOINT = "/dispatch/bulk"
+BULK_DISPATCH = False
+
+# Full URL of every fixed endpoint, so call_api does not rebuild it per request.
+URLS = {
+    endpoint: BASE_URL + endpoint
+    for endpoint in (
+        "/locations", "/calls/queue", "/calls/next", "/control/reset", "/control/stop",
+        BULK_DISPATCH_ENDPOINT, *SEARCH_ENDPOINTS.values(), *ENDPOINTS.values()
+    )
+}
+
+# ETag and parsed calls of the last /calls/queue response; an unchanged queue
+# answers If-None-Match with an empty 304 and the cached calls are reused.
+queue_etag = None
+queue_calls = []
+
+# Caps in-flight dispatches so a large batch cannot starve the cache updater;
+# main() creates it so it is bound to the running event loop.
+dispatch_semaphore = None
+
+# Set once REFRESH_EVERY_DISPATCHES dispatches went out since the last refresh;
+# main() creates it so it is bound to the running event loop.
+refresh_event = None
+dispatches_since_refresh = 0
+
+async def call_api(session, endpoint, method="GET", payload=None, params=None, data=None):
+    """Call the API; 'data' is an already-encoded JSON body sent instead of 'payload'."""
+    url = URLS.get(endpoint) or BASE_URL + endpoint
+    method = method.upper()
+    if method not in ("GET", "POST"):
+        raise ValueError("Unsupported HTTP method")
+    headers = JSON_HEADERS if data is not None else None
     try:
-        if method.upper() == "GET":
-            async with session.get(url, params=params) as response:
-                response.raise_for_status()
-                text = await response.text()
-                if not text.strip():
-                    return ""
-                try:
-                    return await response.json()
-                except Exception:
-                    return text
-        elif method.upper() == "POST":
-            async with session.post(url, json=payload, params=params) as response:
-                response.raise_for_status()
-                text = await response.text()
-                if not text.strip():
-                    return ""
-                try:
-                    return await response.json()
-                except Exception:
-                    return text
-        else:
-            raise ValueError("Unsupported HTTP method")
-    except Exception:
+        async with session.request(
+            method, url, json=payload, data=data, params=params, headers=headers
+        ) as response:
+            response.raise_for_status()
+            raw = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         return None
-
-def euclidean_distance(coord1, coord2):
-    return math.hypot(coord1[0] - coord2[0], coord1[1] - coord2[1])
+    if not raw.strip():
+        return ""
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return raw.decode("utf-8", "replace")
 
 async def get_location_details(session):
     data = await call_api(session, "/locations")
@@ -74,6 +130,33 @@ async def get_location_details(session):
         }
     return locations
 
+def build_city_index(location_details):
+    """Precompute, for every city, all cities ordered by distance from it (the city set never changes)."""
+    global nearest, source_payloads, target_payloads
+    city_list = list(location_details)
+    # b'"sourceCounty":..,"sourceCity":..' and b'"targetCounty":..,"targetCity":..'
+    source_payloads = {
+        city: orjson.dumps({"sourceCounty": loc["county"], "sourceCity": loc["city"]})[1:-1]
+        for city, loc in location_details.items()
+    }
+    target_payloads = {
+        city: orjson.dumps({"targetCounty": loc["county"], "targetCity": loc["city"]})[1:-1]
+        for city, loc in location_details.items()
+    }
+    coord_of = {city: (loc["latitude"], loc["longitude"]) for city, loc in location_details.items()}
+    # float32 halves the N x N distance matrix; cities are far enough apart that
+    # the lost precision never changes their order.
+    coords = np.array([coord_of[city] for city in city_list], dtype=np.float32)
+    # Squared distances: only used for ordering, so the square root is skipped.
+    dx = coords[:, None, 0] - coords[None, :, 0]
+    dy = coords[:, None, 1] - coords[None, :, 1]
+    order = np.argsort(dx * dx + dy * dy, axis=1, kind="stable")
+    # Plain tuples of names keep the per-emergency walk free of NumPy scalar boxing
+    # and let it stop lazily at the first cities that cover the request.
+    nearest = {
+        city: tuple(city_list[idx] for idx in row) for city, row in zip(city_list, order.tolist())
+    }
+
 async def get_available(session, endpoint):
     data = await call_api(session, endpoint)
     if not data:
@@ -85,49 +168,119 @@ async def get_available(session, endpoint):
         available[city] = count
     return available
 
-async def dispatch(session, endpoint, source_city, target_city, count, location_details):
-    src = location_details.get(source_city)
-    tgt = location_details.get(target_city)
+def count_dispatches(count):
+    """Record successful dispatches and wake the cache updater once enough went out."""
+    global dispatches_since_refresh
+    dispatches_since_refresh += count
+    if dispatches_since_refresh >= REFRESH_EVERY_DISPATCHES:
+        refresh_event.set()
+
+async def dispatch(session, endpoint, source_city, target_city, count):
+    src = source_payloads.get(source_city)
+    tgt = target_payloads.get(target_city)
     if not src or not tgt:
         return None
-    payload = {
-        "sourceCounty": src["county"],
-        "sourceCity": src["city"],
-        "targetCounty": tgt["county"],
-        "targetCity": tgt["city"],
-        "quantity": count
-    }
-    result = await call_api(session, endpoint, method="POST", payload=payload)
+    body = b'{%s,%s,"quantity":%d}' % (src, tgt, count)
+    async with dispatch_semaphore:
+        result = await call_api(session, endpoint, method="POST", data=body)
+    if result is not None:
+        count_dispatches(1)
+    return result
+
+async def dispatch_bulk(session, plan, target_city):
+    """Send every (service, source city, count) entry of 'plan' in one bulk POST."""
+    tgt = target_payloads.get(target_city)
+    if not tgt:
+        return None
+    items = [
+        b'{"service":"%s",%s,%s,"quantity":%d}' % (service.encode(), source_payloads[city], tgt, count)
+        for service, city, count in plan
+    ]
+    body = b'{"dispatches":[%s]}' % b",".join(items)
+    async with dispatch_semaphore:
+        result = await call_api(session, BULK_DISPATCH_ENDPOINT, method="POST", data=body)
+    if result is not None:
+        count_dispatches(len(plan))
     return result
 
+async def send_dispatches(session, plan, target_city):
+    """Send an emergency's dispatches in one bulk POST with BULK_DISPATCH, or one by one if that is off or fails."""
+    if BULK_DISPATCH and await dispatch_bulk(session, plan, target_city) is not None:
+        return
+    await asyncio.gather(*[
+        dispatch(session, ENDPOINTS[service], city, target_city, count)
+        for service, city, count in plan
+    ])
+
 async def update_availability_cache(session, interval=5):
-    """Background task that updates the global availability cache for all five services every 'interval' seconds."""
-    global availability_cache
+    """
+    Background task that updates the global availability cache for all five services.
+    Refreshes every 'interval' seconds, or earlier once refresh_event is set by dispatch().
+    """
+    global availability_cache, dispatches_since_refresh
     while True:
+        refresh_event.clear()
+        dispatches_since_refresh = 0
+        # Dispatches still in flight when the searches go out may be missing from
+        # the new snapshot, so they stay pending together with later reservations.
+        settling = {
+            service: defaultdict(int, units) for service, units in in_flight_units.items()
+        }
+        for units in reserved_since_poll.values():
+            units.clear()
         try:
             # Use asyncio.gather to fetch availability for each service concurrently.
-            med, fire, police, rescue, utility = await asyncio.gather(
-                get_available(session, "/medical/search"),
-                get_available(session, "/fire/search"),
-                get_available(session, "/police/search"),
-                get_available(session, "/rescue/search"),
-                get_available(session, "/utility/search")
-            )
-            async with cache_lock:
-                availability_cache["Medical"] = med
-                availability_cache["Fire"] = fire
-                availability_cache["Police"] = police
-                availability_cache["Rescue"] = rescue
-                availability_cache["Utility"] = utility
+            snapshots = await asyncio.gather(*[
+                get_available(session, endpoint) for endpoint in SEARCH_ENDPOINTS.values()
+            ])
+            # Swap in the new snapshots and their pending units in one step; no await
+            # can interleave here.
+            availability_cache.update(zip(SEARCH_ENDPOINTS, snapshots))
+            for service, units in settling.items():
+                for city, count in reserved_since_poll[service].items():
+                    units[city] += count
+            pending_units.update(settling)
         except Exception:
             # In production, log errors appropriately.
             pass
-        await asyncio.sleep(interval)
+        try:
+            await asyncio.wait_for(refresh_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+def allocate(service_type, nearest_cities, quantity_needed, plan):
+    """
+    Reserve up to 'quantity_needed' units of 'service_type', walking 'nearest_cities'
+    nearest-first, and append a (service, city, count) entry to 'plan' per source.
+    Never awaits, so no other coroutine can interleave. Returns the units left unassigned.
+    """
+    snapshot = availability_cache[service_type]
+    pending = pending_units[service_type]
+    reserved = reserved_since_poll[service_type]
+    in_flight = in_flight_units[service_type]
+    remaining = quantity_needed
+    for city in nearest_cities:
+        if remaining <= 0:
+            break
+        # Most cities are empty, so check the snapshot before looking at pending units.
+        avail_count = snapshot.get(city, 0)
+        if avail_count <= 0:
+            continue
+        avail_count -= pending.get(city, 0)
+        if avail_count <= 0:
+            continue
+        dispatch_count = min(avail_count, remaining)
+        pending[city] += dispatch_count
+        reserved[city] += dispatch_count
+        in_flight[city] += dispatch_count
+        remaining -= dispatch_count
+        plan.append((service_type, city, dispatch_count))
+    return remaining
 
 async def process_multi_service_emergency_shared(session, call, location_details):
     """
     Process a single emergency call that may request any of the five emergency services.
-    Uses the shared availability cache and updates it atomically to avoid overdispatch.
+    Reserves units against the shared availability snapshot to avoid overdispatch.
     """
     target_city = call.get("city")
     if not target_city or target_city not in location_details:
@@ -137,11 +290,9 @@ async def process_multi_service_emergency_shared(session, call, location_details
     if not requests_list:
         return False
 
-    target_coord = (
-        location_details[target_city]["latitude"],
-        location_details[target_city]["longitude"]
-    )
+    nearest_cities = nearest[target_city]
     all_success = True
+    plan = []
 
     for req in requests_list:
         service_type = req.get("Type")
@@ -149,52 +300,66 @@ async def process_multi_service_emergency_shared(session, call, location_details
         if quantity_needed <= 0:
             continue
 
-        # Build candidate list using cached data.
-        async with cache_lock:
-            available = availability_cache.get(service_type)
-            if available is None:
-                continue
-            candidates = [
-                (city, euclidean_distance(
-                    (location_details[city]["latitude"], location_details[city]["longitude"]),
-                    target_coord
-                ))
-                for city, count in available.items() if count > 0 and city in location_details
-            ]
-        candidates.sort(key=lambda candidate: candidate[1])
-
-        remaining = quantity_needed
-        for city, _ in candidates:
-            if remaining <= 0:
-                break
-            dispatch_count = 0
-            async with cache_lock:
-                current_avail = availability_cache.get(service_type, {}).get(city, 0)
-                if current_avail > 0:
-                    dispatch_count = min(current_avail, remaining)
-                    availability_cache[service_type][city] = current_avail - dispatch_count
-            if dispatch_count > 0:
-                endpoint = {
-                    "Medical": "/medical/dispatch",
-                    "Fire": "/fire/dispatch",
-                    "Police": "/police/dispatch",
-                    "Rescue": "/rescue/dispatch",
-                    "Utility": "/utility/dispatch"
-                }.get(service_type)
-                if endpoint:
-                    await dispatch(session, endpoint, city, target_city, dispatch_count, location_details)
-                    remaining -= dispatch_count
-
+        if service_type not in availability_cache or service_type not in ENDPOINTS:
+            continue
+        remaining = allocate(service_type, nearest_cities, quantity_needed, plan)
         if remaining > 0:
             all_success = False
+
+    # Send all dispatches for this emergency at once.
+    try:
+        if plan:
+            await send_dispatches(session, plan, target_city)
+    finally:
+        for service_type, city, count in plan:
+            in_flight_units[service_type][city] -= count
     return all_success
 
+async def process_batch(session, calls, location_details, limit):
+    """
+    Process 'calls' concurrently and return how many were fully served.
+    Stops as soon as 'limit' calls succeeded and cancels the rest of the batch.
+    """
+    tasks = [
+        asyncio.create_task(process_multi_service_emergency_shared(session, call, location_details))
+        for call in calls if call
+    ]
+    processed = 0
+    pending = set(tasks)
+    try:
+        while pending and processed < limit:
+            # Drain every call that finished since the last wakeup in one go.
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    if task.result():
+                        processed += 1
+                except Exception as e:
+                    print(f"Error processing call: {e!r}")
+    finally:
+        for task in pending:
+            task.cancel()
+    return processed
+
 async def get_pending_calls(session):
+    global queue_etag, queue_calls
     params = {"limit": SIMULATION_CONFIG["maxActiveCalls"]}
-    data = await call_api(session, "/calls/queue", params=params)
-    if not data:
+    headers = {"If-None-Match": queue_etag} if queue_etag else None
+    try:
+        async with session.get(URLS["/calls/queue"], params=params, headers=headers) as response:
+            if response.status == 304:
+                return queue_calls
+            response.raise_for_status()
+            raw = await response.read()
+            etag = response.headers.get("ETag")
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         return []
-    return data
+    try:
+        data = orjson.loads(raw) if raw.strip() else []
+    except orjson.JSONDecodeError:
+        data = []
+    queue_etag, queue_calls = etag, data if isinstance(data, list) else []
+    return queue_calls
 
 async def request_next_call(session):
     data = await call_api(session, "/calls/next")
@@ -203,9 +368,24 @@ async def request_next_call(session):
     return data
 
 async def main():
-    async with aiohttp.ClientSession() as session:
+    global dispatch_semaphore, refresh_event
+    dispatch_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DISPATCHES)
+    refresh_event = asyncio.Event()
+    # Unbounded, long-lived keep-alive pool so concurrent dispatches never wait for a socket.
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=1024, ttl_dns_cache=600, keepalive_timeout=75)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        headers={"Connection": "keep-alive"},
+        timeout=aiohttp.ClientTimeout(total=30)
+    ) as session, aiohttp.ClientSession(
+        # The availability poller gets its own keep-alive pool, one socket per search
+        # endpoint, so its polls never queue behind dispatch traffic.
+        connector=aiohttp.TCPConnector(limit=len(availability_cache), keepalive_timeout=75),
+        headers={"Connection": "keep-alive"},
+        timeout=aiohttp.ClientTimeout(total=30)
+    ) as poll_session:
         # Start the background updater for the availability cache.
-        cache_task = asyncio.create_task(update_availability_cache(session, interval=5))
+        cache_task = asyncio.create_task(update_availability_cache(poll_session, interval=5))
 
         # Reset the simulation.
         reset_result = await call_api(session, "/control/reset", method="POST", params=SIMULATION_CONFIG)
@@ -214,6 +394,7 @@ async def main():
             return
 
         location_details = await get_location_details(session)
+        build_city_index(location_details)
         total_calls_processed = 0
 
         while total_calls_processed < SIMULATION_CONFIG["targetDispatches"]:
@@ -226,20 +407,17 @@ async def main():
                 if not next_call:
                     break
                 pending_calls = [next_call]
-            coros = [
-                process_multi_service_emergency_shared(session, call, location_details)
-                for call in pending_calls if call
-            ]
-            results = await asyncio.gather(*coros, return_exceptions=True)
-            for result in results:
-                if result is True:
-                    total_calls_processed += 1
-                    if total_calls_processed >= SIMULATION_CONFIG["targetDispatches"]:
-                        break
+            total_calls_processed += await process_batch(
+                session, pending_calls, location_details,
+                SIMULATION_CONFIG["targetDispatches"] - total_calls_processed
+            )
 
         stop_result = await call_api(session, "/control/stop", method="POST")
         print(stop_result)
         cache_task.cancel()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -3,14 +3,35 @@
 # Total emergency calls processed: 257
 
 #!/usr/bin/env python3
-import math
+import asyncio
 import time
-import requests
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+import orjson
+import logging
+import queue
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+import aiohttp
+import numpy as np
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows.
+    uvloop = None
+
+log = logging.getLogger(__name__)
 
 BASE_URL = "http://localhost:5000"
+# Request bodies are pre-encoded with orjson and sent with this header.
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Full URL of every fixed endpoint, so call_api does not rebuild it per request.
+URLS = {
+    endpoint: BASE_URL + endpoint
+    for endpoint in (
+        "/locations", "/calls/queue", "/calls/next", "/control/reset", "/control/stop", "/resources/search",
+        "/medical/search", "/fire/search", "/police/search",
+        "/medical/dispatch", "/fire/dispatch", "/police/dispatch"
+    )
+}
 SIMULATION_CONFIG = {
     "seed": "default",
     "targetDispatches": 1000,  # Total emergencies to be generated
@@ -20,36 +41,73 @@ SIMULATION_CONFIG = {
 # Maximum consecutive polls for emptiness before we decide there are no further calls.
 MAX_CONSECUTIVE_EMPTY_CALLS = 1
 
-# Create a global session for connection reuse.
-session = requests.Session()
-
-def call_api(endpoint, method="GET", payload=None, params=None):
-    url = f"{BASE_URL}{endpoint}"
+# Maximum number of emergency calls processed concurrently.
+MAX_CONCURRENT_CALLS = 50
+
+# Re-fetch the shared availability snapshot after this many finished calls, so it
+# is also corrected under steady load when calls are always in progress.
+SNAPSHOT_REFRESH_CALLS = 100
+
+# While calls are in progress, /calls/queue is re-polled once this many of them
+# finished, or this many seconds after the first one did, not once per finished call.
+POLL_DEBOUNCE_CALLS = 10
+POLL_DEBOUNCE_SECONDS = 0.05
+
+# Dispatch endpoint and logged unit name for each service type.
+DISPATCH_ENDPOINTS = {"Medical": "/medical/dispatch", "Fire": "/fire/dispatch", "Police": "/police/dispatch"}
+DISPATCH_UNITS = {"Medical": "ambulance(s)", "Fire": "firefighter unit(s)", "Police": "police unit(s)"}
+# Send each service's dispatches for a call as one batched POST of
+# {"targetCounty", "targetCity", "dispatches": [...]}. Only enable this for an
+# emulator whose dispatch endpoints accept that payload; it is never probed.
+BATCHED_DISPATCH = False
+
+# ETag and parsed calls of the last /calls/queue response; an unchanged queue
+# answers If-None-Match with an empty 304 and the cached calls are reused.
+queue_etag = None
+queue_calls = []
+
+# Producer/consumer bookkeeping shared by produce_calls() and consume_calls(). Their
+# queue and events are created by main(), so they are bound to the running loop.
+calls_in_progress = Counter()  # call_key() -> number of such calls queued or being processed.
+calls_finished_at = {}  # call_key() -> time.monotonic() when its processing finished.
+total_calls_processed = 0
+calls_finished_total = 0  # Calls finished so far, successful or not.
+calls_since_refresh = 0  # Calls finished since produce_calls() last refreshed the snapshot.
+dispatches_since_refresh = 0  # Dispatches sent since produce_calls() last refreshed the snapshot.
+
+# City names and their positions in every per-city array, built once by build_city_index().
+city_list = []
+city_index = {}
+# nearest_order[i] lists every city index sorted by distance from city i, nearest first.
+nearest_order = np.empty((0, 0), dtype=np.int32)
+# Fixed halves of every dispatch payload, per city, built once by build_city_index().
+source_templates = {}
+target_templates = {}
+
+async def call_api(session, endpoint, method="GET", payload=None, params=None):
+    url = URLS.get(endpoint) or BASE_URL + endpoint
+    method = method.upper()
+    if method not in ("GET", "POST"):
+        raise ValueError("Unsupported HTTP method")
+    data = orjson.dumps(payload) if payload is not None else None
+    headers = JSON_HEADERS if data is not None else None
     try:
-        if method.upper() == "GET":
-            response = session.get(url, params=params)
-        elif method.upper() == "POST":
-            response = session.post(url, json=payload, params=params)
-        else:
-            raise ValueError("Unsupported HTTP method")
-        response.raise_for_status()
-
-        if response.text.strip() == "":
-            return ""
-        try:
-            return response.json()
-        except Exception:
-            return response.text
-    except requests.RequestException as e:
-        print(f"Error during API call to {endpoint}: {e}")
+        async with session.request(method, url, data=data, params=params, headers=headers) as response:
+            response.raise_for_status()
+            raw = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.error("Error during API call to %s: %s", endpoint, e)
         return None
 
-def euclidean_distance(coord1, coord2):
-    """Compute the Euclidean (linear) distance between two 2D points."""
-    return math.hypot(coord1[0] - coord2[0], coord1[1] - coord2[1])
+    if not raw.strip():
+        return ""
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return raw.decode("utf-8", "replace")
 
-def get_location_details():
-    data = call_api("/locations")
+async def get_location_details(session):
+    data = await call_api(session, "/locations")
     if not data:
         raise RuntimeError("Failed to retrieve locations")
     locations = {}
@@ -71,269 +129,466 @@ def get_location_details():
         }
     return locations
 
-def get_available_ambulances():
-    data = call_api("/medical/search")
+def build_city_index(location_details):
+    """
+    Lay the city coordinates out as float32 arrays (one per axis), indexed by city_index,
+    and precompute each city's nearest-first order and dispatch payload halves.
+    """
+    global city_list, city_index, nearest_order, source_templates, target_templates
+    city_list = list(location_details)
+    city_index = {city: i for i, city in enumerate(city_list)}
+    lats = np.array([location_details[city]["latitude"] for city in city_list], dtype=np.float32)
+    lons = np.array([location_details[city]["longitude"] for city in city_list], dtype=np.float32)
+    dx = lats[:, None] - lats[None, :]
+    dy = lons[:, None] - lons[None, :]
+    # Squared distance ranks the same as distance.
+    nearest_order = np.argsort(dx * dx + dy * dy, axis=1, kind="stable").astype(np.int32)
+    source_templates = {city: {"sourceCounty": d["county"], "sourceCity": city} for city, d in location_details.items()}
+    target_templates = {city: {"targetCounty": d["county"], "targetCity": city} for city, d in location_details.items()}
+
+def nearest_sources(counts, target_city, quantity_needed):
+    """
+    Greedily take up to 'quantity_needed' units out of 'counts' from the cities
+    nearest to 'target_city'. Returns (source city indices, units taken from each),
+    nearest first; fewer units are taken if 'counts' runs out.
+    """
+    order = nearest_order[city_index[target_city]]
+    # Every city with units holds at least one, so the nearest 'quantity_needed' suffice.
+    src_idx = order[counts[order] > 0][:quantity_needed]
+    cs = np.cumsum(counts[src_idx])
+    # The first prefix whose units cover the request, or every candidate if none does.
+    cutoff = min(int(np.searchsorted(cs, quantity_needed)) + 1, len(cs))
+    src_idx = src_idx[:cutoff]
+    take = counts[src_idx]
+    if cutoff:
+        take[-1] -= max(int(cs[cutoff - 1]) - quantity_needed, 0)
+    counts[src_idx] -= take
+    return src_idx, take
+
+def availability_counts(data):
+    """
+    Turn a search response into an int32 array of available units indexed like city_list.
+    Cities missing from the locations list can never be ranked, so they are dropped.
+    """
+    counts = np.zeros(len(city_list), dtype=np.int32)
+    for item in data:
+        i = city_index.get(item.get("city") or item.get("name"))
+        if i is not None:
+            counts[i] = item.get("available", item.get("quantity", 0))
+    return counts
+
+async def get_available_ambulances(session):
+    data = await call_api(session, "/medical/search")
     if not data:
         raise RuntimeError("Failed to retrieve available ambulances")
-    available = {}
-    for item in data:
-        city = item.get("city") or item.get("name") or "unknown"
-        count = item.get("available", item.get("quantity", 0))
-        available[city] = count
-    return available
+    return availability_counts(data)
 
-def get_available_firefighters():
-    data = call_api("/fire/search")
+async def get_available_firefighters(session):
+    data = await call_api(session, "/fire/search")
     if not data:
         raise RuntimeError("Failed to retrieve available firefighters")
-    available = {}
-    for item in data:
-        city = item.get("city") or item.get("name") or "unknown"
-        count = item.get("available", item.get("quantity", 0))
-        available[city] = count
-    return available
+    return availability_counts(data)
 
-def get_available_police():
-    data = call_api("/police/search")
+async def get_available_police(session):
+    data = await call_api(session, "/police/search")
     if not data:
         raise RuntimeError("Failed to retrieve available police vehicles")
-    available = {}
-    for item in data:
-        city = item.get("city") or item.get("name") or "unknown"
-        count = item.get("available", item.get("quantity", 0))
-        available[city] = count
-    return available
-
-def dispatch_ambulances(source_city, target_city, count, location_details):
-    source_detail = location_details.get(source_city)
-    target_detail = location_details.get(target_city)
-    if source_detail is None or target_detail is None:
-        print("Error: Missing location details for ambulance dispatch.")
-        return None
-    payload = {
-        "sourceCounty": source_detail.get("county"),
-        "sourceCity": source_detail.get("city"),
-        "targetCounty": target_detail.get("county"),
-        "targetCity": target_detail.get("city"),
-        "quantity": count
-    }
-    result = call_api("/medical/dispatch", method="POST", payload=payload)
-    if result is None:
-        print(f"Dispatch error: Unable to dispatch {count} ambulance(s) from {source_city} to {target_city}.")
-    else:
-        print(f"Dispatched {count} ambulance(s) from {source_city} to {target_city}.")
-    return result
-
-def dispatch_firefighters(source_city, target_city, count, location_details):
-    source_detail = location_details.get(source_city)
-    target_detail = location_details.get(target_city)
-    if source_detail is None or target_detail is None:
-        print("Error: Missing location details for firefighter dispatch.")
-        return None
-    payload = {
-        "sourceCounty": source_detail.get("county"),
-        "sourceCity": source_detail.get("city"),
-        "targetCounty": target_detail.get("county"),
-        "targetCity": target_detail.get("city"),
-        "quantity": count
-    }
-    result = call_api("/fire/dispatch", method="POST", payload=payload)
-    if result is None:
-        print(f"Dispatch error: Unable to dispatch {count} firefighter unit(s) from {source_city} to {target_city}.")
-    else:
-        print(f"Dispatched {count} firefighter unit(s) from {source_city} to {target_city}.")
-    return result
-
-def dispatch_police(source_city, target_city, count, location_details):
-    source_detail = location_details.get(source_city)
-    target_detail = location_details.get(target_city)
-    if source_detail is None or target_detail is None:
-        print("Error: Missing location details for police dispatch.")
-        return None
-    payload = {
-        "sourceCounty": source_detail.get("county"),
-        "sourceCity": source_detail.get("city"),
-        "targetCounty": target_detail.get("county"),
-        "targetCity": target_detail.get("city"),
-        "quantity": count
-    }
-    result = call_api("/police/dispatch", method="POST", payload=payload)
-    if result is None:
-        print(f"Dispatch error: Unable to dispatch {count} police unit(s) from {source_city} to {target_city}.")
-    else:
-        print(f"Dispatched {count} police unit(s) from {source_city} to {target_city}.")
-    return result
-
-def process_multi_service_emergency(call, location_details):
+    return availability_counts(data)
+
+# Re-fetches a single service's availability when its snapshot goes stale.
+AVAILABILITY_FETCHERS = {
+    "Medical": get_available_ambulances,
+    "Fire": get_available_firefighters,
+    "Police": get_available_police
+}
+
+# Units per service (int32 arrays indexed like city_list) taken out of the shared
+# snapshot whose dispatch POSTs have not returned yet.
+units_in_flight = {}
+# One {service type: units} counter per running refresh_snapshot(), counting the
+# units taken while its searches are outstanding.
+refresh_reservations = []
+
+# Returns every service's availability in one response. Only enable AGGREGATE_SEARCH
+# for an emulator that serves it; it is never probed.
+AGGREGATE_SEARCH_ENDPOINT = "/resources/search"
+AGGREGATE_SEARCH = False
+
+async def get_available_resources(session):
+    """
+    Fetch one availability snapshot for every service type, from the aggregate
+    endpoint with AGGREGATE_SEARCH, else (or if its response lacks a list for
+    some service) with concurrent searches per service.
+    """
+    if AGGREGATE_SEARCH:
+        data = await call_api(session, AGGREGATE_SEARCH_ENDPOINT)
+        if isinstance(data, dict) and all(
+            isinstance(data.get(service_type.lower()), list) for service_type in AVAILABILITY_FETCHERS
+        ):
+            return {
+                service_type: availability_counts(data[service_type.lower()])
+                for service_type in AVAILABILITY_FETCHERS
+            }
+        log.warning("Unexpected aggregate search response; falling back to per-service searches.")
+    snapshots = await asyncio.gather(*(fetch(session) for fetch in AVAILABILITY_FETCHERS.values()))
+    return dict(zip(AVAILABILITY_FETCHERS, snapshots))
+
+async def refresh_snapshot(session, available_resources, service_types=None):
+    """
+    Re-fetch the availability of 'service_types' (every service when None) into
+    'available_resources'. Units in flight when the searches are sent, and units
+    taken while they run, may not show on the server yet, so they are held back.
+    """
+    service_types = list(service_types or AVAILABILITY_FETCHERS)
+    held = {service_type: units_in_flight[service_type].copy() for service_type in service_types}
+    reserved = {service_type: np.zeros_like(units) for service_type, units in held.items()}
+    refresh_reservations.append(reserved)
+    try:
+        if len(service_types) == len(AVAILABILITY_FETCHERS):
+            fresh = await get_available_resources(session)
+        else:
+            snapshots = await asyncio.gather(*(AVAILABILITY_FETCHERS[s](session) for s in service_types))
+            fresh = dict(zip(service_types, snapshots))
+    finally:
+        refresh_reservations.remove(reserved)
+    for service_type in service_types:
+        counts = fresh[service_type] - held[service_type] - reserved[service_type]
+        available_resources[service_type] = np.maximum(counts, 0).astype(np.int32)
+
+async def post_dispatches(session, endpoint, sources, target_city):
+    """
+    Send every (source city, count) pair in 'sources' to one target through 'endpoint'.
+    With BATCHED_DISPATCH they go in a single POST; otherwise the individual
+    dispatches are sent concurrently. Returns one result per source.
+    """
+    if BATCHED_DISPATCH:
+        payload = {
+            **target_templates[target_city],
+            "dispatches": [{**source_templates[city], "quantity": count} for city, count in sources]
+        }
+        result = await call_api(session, endpoint, method="POST", payload=payload)
+        return [result] * len(sources)
+    return await asyncio.gather(*(
+        call_api(session, endpoint, method="POST", payload={
+            **source_templates[city], **target_templates[target_city], "quantity": count
+        })
+        for city, count in sources
+    ))
+
+async def dispatch(session, service_type, sources, target_city):
+    """
+    Dispatch 'service_type' units from every (source city, count) in 'sources' to 'target_city'.
+    """
+    if target_city not in target_templates or any(city not in source_templates for city, _ in sources):
+        log.error("Error: Missing location details for %s dispatch.", service_type)
+        return [None] * len(sources)
+    units = DISPATCH_UNITS[service_type]
+    results = await post_dispatches(session, DISPATCH_ENDPOINTS[service_type], sources, target_city)
+    for (source_city, count), result in zip(sources, results):
+        if result is None:
+            log.error("Dispatch error: Unable to dispatch %s %s from %s to %s.", count, units, source_city, target_city)
+        else:
+            log.debug("Dispatched %s %s from %s to %s.", count, units, source_city, target_city)
+    return results
+
+async def process_multi_service_emergency(session, call, location_details, available_resources):
     """
     Process an emergency call that may request multiple service types.
-    This version executes the three resource availability API calls concurrently.
+    Dispatches are planned against the batch's shared 'available_resources'
+    snapshot without awaiting, so concurrent calls never plan from the same
+    units, and are then sent concurrently.
     """
+    global dispatches_since_refresh
     target_city = call.get("city")
     if not target_city:
-        print("Error: Emergency call missing 'city' field.")
+        log.error("Error: Emergency call missing 'city' field.")
         return False
 
     requests_list = call.get("requests", [])
     if not requests_list:
-        print("Error: No service requests provided in the call.")
+        log.error("Error: No service requests provided in the call.")
         return False
 
-    # Fetch available resources concurrently.
-    with ThreadPoolExecutor(max_workers=3) as local_executor:
-        future_med = local_executor.submit(get_available_ambulances)
-        future_fire = local_executor.submit(get_available_firefighters)
-        future_police = local_executor.submit(get_available_police)
-        available_resources = {
-            "Medical": future_med.result(),
-            "Fire": future_fire.result(),
-            "Police": future_police.result()
-        }
-
+    dispatches = []  # One dispatch coroutine per service, sent together below.
+    dispatched_services = []  # Service type of each planned dispatch.
+    reservations = []  # (service type, source indices, units) held in units_in_flight.
     all_success = True  # Track if all dispatches were fulfilled
     for req in requests_list:
         service_type = req.get("Type")
         quantity_needed = req.get("Quantity", 0)
         if quantity_needed <= 0:
-            print(f"Skipping service '{service_type}' with non-positive quantity {quantity_needed}.")
+            log.debug("Skipping service '%s' with non-positive quantity %s.", service_type, quantity_needed)
             continue
 
-        print(f"\nEmergency call: {quantity_needed} unit(s) of {service_type} required at {target_city}.")
+        log.debug("Emergency call: %s unit(s) of %s required at %s.", quantity_needed, service_type, target_city)
         if target_city not in location_details:
-            print(f"Error: Target city '{target_city}' not found in location details.")
+            log.error("Error: Target city '%s' not found in location details.", target_city)
             continue
 
-        target_coord = (location_details[target_city]["latitude"], location_details[target_city]["longitude"])
         available = available_resources.get(service_type)
         if available is None:
-            print(f"Error: Unknown service type '{service_type}'.")
+            log.error("Error: Unknown service type '%s'.", service_type)
             continue
 
-        # Gather candidate cities with available units, sorted by Euclidean distance.
-        candidates = []
-        for city, count in available.items():
-            if count > 0 and city in location_details:
-                source_detail = location_details[city]
-                source_coord = (source_detail["latitude"], source_detail["longitude"])
-                distance = euclidean_distance(source_coord, target_coord)
-                candidates.append((city, distance, count))
-        candidates.sort(key=lambda candidate: candidate[1])
-
-        remaining = quantity_needed
-        for city, distance, avail_count in candidates:
-            if remaining <= 0:
-                break
-            dispatch_count = min(avail_count, remaining)
-            if service_type == "Medical":
-                dispatch_ambulances(city, target_city, dispatch_count, location_details)
-            elif service_type == "Fire":
-                dispatch_firefighters(city, target_city, dispatch_count, location_details)
-            elif service_type == "Police":
-                dispatch_police(city, target_city, dispatch_count, location_details)
-            else:
-                print(f"Unknown service type: {service_type}")
-                continue
-            available[city] -= dispatch_count
-            remaining -= dispatch_count
+        src_idx, take = nearest_sources(available, target_city, quantity_needed)
+        remaining = quantity_needed - int(take.sum())
+        sources = [(city_list[i], count) for i, count in zip(src_idx.tolist(), take.tolist())]
+
+        if sources:
+            units_in_flight[service_type][src_idx] += take
+            for reserved in refresh_reservations:
+                if service_type in reserved:
+                    reserved[service_type][src_idx] += take
+            reservations.append((service_type, src_idx, take))
+            dispatches.append(dispatch(session, service_type, sources, target_city))
+            dispatched_services.append(service_type)
 
         if remaining > 0:
-            print(f"Warning: Unable to dispatch {remaining} unit(s) of {service_type} for {target_city}!")
+            log.warning("Warning: Unable to dispatch %s unit(s) of %s for %s!", remaining, service_type, target_city)
             all_success = False
         else:
-            print(f"Emergency resolved: all required {service_type} units dispatched successfully.")
+            log.debug("Emergency resolved: all required %s units dispatched successfully.", service_type)
+
+    dispatches_since_refresh += len(dispatches)
+    try:
+        results = await asyncio.gather(*dispatches)
+    finally:
+        for service_type, src_idx, take in reservations:
+            units_in_flight[service_type][src_idx] -= take
+    # A rejected dispatch means that service's snapshot no longer matches the server.
+    stale = {s for s, service_results in zip(dispatched_services, results) if None in service_results}
+    if stale:
+        await refresh_snapshot(session, available_resources, stale)
     return all_success
 
-def get_pending_calls():
+def call_key(call):
+    """
+    Identify a call across /calls/queue polls, by its id when the emulator sends one.
+    Otherwise quantities are left out because the server lowers them as dispatches
+    land while the call is still being processed, so identical calls share a key.
+    """
+    call_id = call.get("id")
+    if call_id is not None:
+        return call_id
+    return (call.get("county"), call.get("city"), tuple(req.get("Type") for req in call.get("requests", [])))
+
+async def wait_for_finished_calls(call_finished, finished_before):
+    """
+    Wait until POLL_DEBOUNCE_CALLS calls finished since 'finished_before' was read
+    from calls_finished_total, nothing is left in progress, or POLL_DEBOUNCE_SECONDS
+    passed since the first call finished.
+    """
+    await call_finished.wait()
+    deadline = time.monotonic() + POLL_DEBOUNCE_SECONDS
+    while calls_in_progress and calls_finished_total - finished_before < POLL_DEBOUNCE_CALLS:
+        call_finished.clear()
+        try:
+            await asyncio.wait_for(call_finished.wait(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            break
+
+async def produce_calls(session, available_resources, call_queue, call_finished, simulation_done):
+    """
+    Keep call_queue fed from /calls/queue while the workers drain it, so the poll
+    round-trip overlaps with dispatching. A polled call is skipped while it is
+    queued or being processed, and also if it finished after the poll was sent,
+    since the poll may predate its dispatches. Of several calls sharing a key,
+    only those beyond the number already in progress are new. While calls are in
+    progress the next poll waits for wait_for_finished_calls().
+    """
+    global calls_since_refresh, dispatches_since_refresh
+    consecutive_empty_calls = 0
+    while not simulation_done.is_set():
+        call_finished.clear()
+        poll_sent = time.monotonic()
+        finished_before = calls_finished_total
+        pending_calls = await get_pending_calls(session)
+        if pending_calls:
+            consecutive_empty_calls = 0
+            polled = Counter()
+            new_calls = []
+            for call in pending_calls:
+                if isinstance(call, str) and call.strip() == "":
+                    continue
+                key = call_key(call)
+                if calls_finished_at.get(key, 0) >= poll_sent:
+                    continue
+                polled[key] += 1
+                if polled[key] > calls_in_progress[key]:
+                    new_calls.append(call)
+            if new_calls:
+                # When idle the snapshot only drifts from the server through dispatches.
+                idle_and_stale = not calls_in_progress and dispatches_since_refresh
+                if idle_and_stale or calls_since_refresh >= SNAPSHOT_REFRESH_CALLS:
+                    calls_since_refresh = dispatches_since_refresh = 0
+                    try:
+                        await refresh_snapshot(session, available_resources)
+                    except RuntimeError as e:
+                        log.warning("Availability refresh failed, keeping the old snapshot: %s", e)
+                log.info("Queueing %s new call(s)...", len(new_calls))
+                for call in new_calls:
+                    calls_in_progress[call_key(call)] += 1
+                    await call_queue.put(call)
+            if calls_in_progress:
+                await wait_for_finished_calls(call_finished, finished_before)
+        else:
+            next_call = await request_next_call(session)
+            if not next_call:
+                consecutive_empty_calls += 1
+                log.info("Queue is empty, requesting next call... "
+                         "(consecutive empty calls: %s)", consecutive_empty_calls)
+                if consecutive_empty_calls >= MAX_CONSECUTIVE_EMPTY_CALLS:
+                    log.info("No further calls available; stopping simulation.")
+                    await call_queue.join()
+                    simulation_done.set()
+            else:
+                consecutive_empty_calls = 0
+
+async def consume_calls(session, location_details, available_resources, call_queue, call_finished, simulation_done):
+    """
+    Process calls from call_queue until cancelled, one at a time per worker.
     """
-    Retrieve emergencies from the /calls/queue endpoint.
+    global total_calls_processed, calls_finished_total, calls_since_refresh
+    while True:
+        call = await call_queue.get()
+        try:
+            if await process_multi_service_emergency(session, call, location_details, available_resources):
+                total_calls_processed += 1
+                if total_calls_processed >= SIMULATION_CONFIG["targetDispatches"]:
+                    simulation_done.set()
+        except Exception as e:
+            log.error("Error processing call: %s", e)
+        finally:
+            key = call_key(call)
+            calls_in_progress[key] -= 1
+            if calls_in_progress[key] <= 0:
+                del calls_in_progress[key]
+            calls_finished_at[key] = time.monotonic()
+            calls_finished_total += 1
+            calls_since_refresh += 1
+            call_finished.set()
+            call_queue.task_done()
+
+async def get_pending_calls(session):
     """
+    Retrieve emergencies from the /calls/queue endpoint, conditionally on queue_etag.
+    """
+    global queue_etag, queue_calls
     params = {"limit": SIMULATION_CONFIG["maxActiveCalls"]}
-    data = call_api("/calls/queue", params=params)
-    if not data or (isinstance(data, str) and data.strip() == ""):
+    headers = {"If-None-Match": queue_etag} if queue_etag else None
+    try:
+        async with session.get(URLS["/calls/queue"], params=params, headers=headers) as response:
+            if response.status == 304:
+                return queue_calls
+            response.raise_for_status()
+            raw = await response.read()
+            etag = response.headers.get("ETag")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.error("Error during API call to /calls/queue: %s", e)
         return []
-    return data
+    try:
+        data = orjson.loads(raw) if raw.strip() else []
+    except orjson.JSONDecodeError:
+        data = []
+    queue_etag, queue_calls = etag, data if isinstance(data, list) else []
+    return queue_calls
 
-def request_next_call():
+async def request_next_call(session):
     """
     Request the next emergency call using the /calls/next endpoint.
     """
-    data = call_api("/calls/next")
+    data = await call_api(session, "/calls/next")
     if not data or (isinstance(data, str) and data.strip() == ""):
         return []
     return data
 
-def main():
-    print("Starting emergency service simulation (optimized)...")
+async def main():
+    log.info("Starting emergency service simulation (optimized)...")
 
-    # Reset the simulation.
-    reset_result = call_api("/control/reset", method="POST", payload=None, params=SIMULATION_CONFIG)
-    if reset_result is None:
-        print("Failed to reset simulation.")
-        return
-    print("Simulation reset successful. Configuration:")
-    print(SIMULATION_CONFIG)
-
-    print("\nFetching locations...")
-    try:
-        location_details = get_location_details()
-    except Exception as e:
-        print("Error getting location details:", e)
-        return
+    # One keep-alive connection pool shared by every concurrent request.
+    connector = aiohttp.TCPConnector(limit=256, limit_per_host=256, keepalive_timeout=75)
+    async with aiohttp.ClientSession(connector=connector, headers={"Connection": "keep-alive"}) as session:
+        # Reset the simulation.
+        reset_result = await call_api(session, "/control/reset", method="POST", payload=None, params=SIMULATION_CONFIG)
+        if reset_result is None:
+            log.error("Failed to reset simulation.")
+            return
+        log.info("Simulation reset successful. Configuration: %s", SIMULATION_CONFIG)
 
-    print(f"Retrieved {len(location_details)} locations.")
+        log.info("Fetching locations...")
+        try:
+            location_details = await get_location_details(session)
+        except Exception as e:
+            log.error("Error getting location details: %s", e)
+            return
 
-    total_calls_processed = 0
-    consecutive_empty_calls = 0
+        build_city_index(location_details)
+        log.info("Retrieved %s locations.", len(location_details))
 
-    # A lock for synchronizing updates to total_calls_processed.
-    counter_lock = threading.Lock()
+        units_in_flight.update({
+            service_type: np.zeros(len(city_list), dtype=np.int32) for service_type in AVAILABILITY_FETCHERS
+        })
 
-    # Create a thread pool for processing emergency calls concurrently.
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        while total_calls_processed < SIMULATION_CONFIG["targetDispatches"]:
-            pending_calls = get_pending_calls()
-            if pending_calls:
-                consecutive_empty_calls = 0
-                print(f"Processing batch of {len(pending_calls)} call(s)...")
-                futures = []
-                for call in pending_calls:
-                    if isinstance(call, str) and call.strip() == "":
-                        continue
-                    # Submit the processing task concurrently.
-                    future = executor.submit(process_multi_service_emergency, call, location_details)
-                    futures.append(future)
-                # As futures complete, update the processed count.
-                for future in as_completed(futures):
-                    try:
-                        success = future.result()
-                        if success:
-                            with counter_lock:
-                                total_calls_processed += 1
-                    except Exception as e:
-                        print("Error processing call:", e)
-                    if total_calls_processed >= SIMULATION_CONFIG["targetDispatches"]:
-                        break
-                # (Optional) Remove or reduce the delay if needed.
-                # time.sleep(0.1)
-            else:
-                next_call = request_next_call()
-                if not next_call:
-                    consecutive_empty_calls += 1
-                    print("Queue is empty, requesting next call... "
-                          f"(consecutive empty calls: {consecutive_empty_calls})")
-                    if consecutive_empty_calls >= MAX_CONSECUTIVE_EMPTY_CALLS:
-                        print("No further calls available; stopping simulation.")
-                        break
-                else:
-                    consecutive_empty_calls = 0
-            # Reduced sleep delay for faster looping.
-            # time.sleep(0.1)
-
-    print("\nAll emergencies processed or no further calls available. Stopping simulation...")
-    stop_result = call_api("/control/stop", method="POST")
-    print("\nSimulation finished. Final results:")
-    print(stop_result)
-    print(f"Total emergency calls processed: {total_calls_processed}")
+        # The snapshot is shared by every worker and kept current by local decrements.
+        try:
+            available_resources = await get_available_resources(session)
+        except RuntimeError as e:
+            log.error("Error getting available resources: %s", e)
+            return
+        call_queue = asyncio.Queue(maxsize=2 * SIMULATION_CONFIG["maxActiveCalls"])
+        call_finished = asyncio.Event()
+        simulation_done = asyncio.Event()
+        pipeline = (call_queue, call_finished, simulation_done)
+        producer = asyncio.create_task(produce_calls(session, available_resources, *pipeline))
+        workers = [
+            asyncio.create_task(consume_calls(session, location_details, available_resources, *pipeline))
+            for _ in range(MAX_CONCURRENT_CALLS)
+        ]
+        # A producer that dies would never set simulation_done, so it ends the run too.
+        done = asyncio.create_task(simulation_done.wait())
+        await asyncio.wait({producer, done}, return_when=asyncio.FIRST_COMPLETED)
+        done.cancel()
+        if producer.done() and not producer.cancelled() and producer.exception():
+            log.error("Call producer stopped: %s", producer.exception())
+
+        # Stop polling, drop calls nobody has started, and let in-flight calls finish.
+        producer.cancel()
+        while not call_queue.empty():
+            call_queue.get_nowait()
+            call_queue.task_done()
+        await call_queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(producer, done, *workers, return_exceptions=True)
+
+        log.info("All emergencies processed or no further calls available. Stopping simulation...")
+        stop_result = await call_api(session, "/control/stop", method="POST")
+        print("\nSimulation finished. Final results:")
+        print(stop_result)
+        print(f"Total emergency calls processed: {total_calls_processed}")
+
+def start_logging():
+    """
+    Route log records through a queue to a background listener writing to stderr,
+    so the processing loop never blocks on the stream.
+    """
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    # Per-dispatch progress is logged at DEBUG.
+    root.setLevel(logging.INFO)
+    listener.start()
+    return listener
 
 if __name__ == '__main__':
-    main()
+    listener = start_logging()
+    try:
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
+    finally:
+        listener.stop()
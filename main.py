@@ -1,10 +1,27 @@
 #!/usr/bin/env python3
-import math
 import time
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
+
+log = logging.getLogger(__name__)
 
 BASE_URL = "http://localhost:5000"
+# Request bodies are pre-encoded with orjson and sent with this header
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Full URL of every fixed endpoint, so call_api does not rebuild it per request
+URLS = {
+    endpoint: BASE_URL + endpoint
+    for endpoint in (
+        "/locations", "/calls/queue", "/calls/next", "/control/reset", "/control/stop", "/resources/search",
+        "/medical/search", "/fire/search", "/police/search",
+        "/medical/dispatch", "/fire/dispatch", "/police/dispatch"
+    )
+}
 
 SIMULATION_CONFIG = {
     "seed": "default",
@@ -15,31 +32,51 @@ SIMULATION_CONFIG = {
 # Maximum consecutive polls for emptiness before we decide there are no further calls.
 MAX_CONSECUTIVE_EMPTY_CALLS = 1
 
+# City names and their positions in every per-city array, built once by build_city_index()
+city_list = []
+city_index = {}
+# nearest_order[i] lists every city index sorted by distance from city i, nearest first
+nearest_order = np.empty((0, 0), dtype=np.int32)
+# Fixed halves of every dispatch payload, per city, built once by build_city_index()
+source_templates = {}
+target_templates = {}
+
+# ETag and parsed calls of the last /calls/queue response; an unchanged queue
+# answers If-None-Match with an empty 304 and the cached calls are reused
+queue_etag = None
+queue_calls = []
+
+# Shared session so every call reuses pooled keep-alive connections
+session = requests.Session()
+# No automatic retries, a retried POST could dispatch twice
+adapter = HTTPAdapter(pool_connections=64, pool_maxsize=256)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+session.headers["Connection"] = "keep-alive"
+
 def call_api(endpoint, method="GET", payload=None, params=None):
-    url = f"{BASE_URL}{endpoint}"
+    url = URLS.get(endpoint) or BASE_URL + endpoint
     try:
         if method.upper() == "GET":
-            response = requests.get(url, params=params)
+            response = session.get(url, params=params)
         elif method.upper() == "POST":
-            response = requests.post(url, json=payload, params=params)
+            data = orjson.dumps(payload) if payload is not None else None
+            headers = JSON_HEADERS if data is not None else None
+            response = session.post(url, data=data, params=params, headers=headers)
         else:
             raise ValueError("Unsupported HTTP method")
         response.raise_for_status()
 
-        if response.text.strip() == "":
+        if not response.content.strip():
             return ""
         try:
-            return response.json()
-        except Exception:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
             return response.text
     except requests.RequestException as e:
-        print(f"Error during API call to {endpoint}: {e}")
+        log.error("Error during API call to %s: %s", endpoint, e)
         return None
 
-def euclidean_distance(coord1, coord2):
-    """Compute the Euclidean (linear) distance between two 2D points."""
-    return math.hypot(coord1[0] - coord2[0], coord1[1] - coord2[1])
-
 def get_location_details():
     data = call_api("/locations")
     if not data:
@@ -64,173 +101,170 @@ def get_location_details():
         }
     return locations
 
+def build_city_index(location_details):
+    """
+    Lay the city coordinates out as float32 arrays (one per axis), indexed by city_index,
+    and precompute each city's nearest-first order and dispatch payload halves.
+    """
+    global city_list, city_index, nearest_order, source_templates, target_templates
+    city_list = list(location_details)
+    city_index = {city: i for i, city in enumerate(city_list)}
+    lats = np.array([location_details[city]["latitude"] for city in city_list], dtype=np.float32)
+    lons = np.array([location_details[city]["longitude"] for city in city_list], dtype=np.float32)
+    dx = lats[:, None] - lats[None, :]
+    dy = lons[:, None] - lons[None, :]
+    # Squared distance ranks the same as distance
+    nearest_order = np.argsort(dx * dx + dy * dy, axis=1, kind="stable").astype(np.int32)
+    source_templates = {city: {"sourceCounty": d["county"], "sourceCity": city} for city, d in location_details.items()}
+    target_templates = {city: {"targetCounty": d["county"], "targetCity": city} for city, d in location_details.items()}
+
+def nearest_sources(counts, target_city, quantity_needed):
+    """
+    Greedily take up to 'quantity_needed' units out of 'counts' from the cities
+    nearest to 'target_city'. Returns (source city indices, units taken from each),
+    nearest first; fewer units are taken if 'counts' runs out.
+    """
+    order = nearest_order[city_index[target_city]]
+    # Every city with units holds at least one, so the nearest 'quantity_needed' suffice
+    src_idx = order[counts[order] > 0][:quantity_needed]
+    cs = np.cumsum(counts[src_idx])
+    # The first prefix whose units cover the request, or every candidate if none does
+    cutoff = min(int(np.searchsorted(cs, quantity_needed)) + 1, len(cs))
+    src_idx = src_idx[:cutoff]
+    take = counts[src_idx]
+    if cutoff:
+        take[-1] -= max(int(cs[cutoff - 1]) - quantity_needed, 0)
+    counts[src_idx] -= take
+    return src_idx, take
+
+def availability_counts(data):
+    """
+    Turn a search response into an int32 array of available units indexed like city_list.
+    Cities missing from the locations list can never be ranked, so they are dropped.
+    """
+    counts = np.zeros(len(city_list), dtype=np.int32)
+    for item in data:
+        i = city_index.get(item.get("city") or item.get("name"))
+        if i is not None:
+            counts[i] = item.get("available", item.get("quantity", 0))
+    return counts
+
 def get_available_ambulances():
     data = call_api("/medical/search")
     if not data:
         raise RuntimeError("Failed to retrieve available ambulances")
-    available = {}
-    for item in data:
-        city = item.get("city") or item.get("name") or "unknown"
-        count = item.get("available", item.get("quantity", 0))
-        available[city] = count
-    return available
+    return availability_counts(data)
 
 def get_available_firefighters():
     data = call_api("/fire/search")
     if not data:
         raise RuntimeError("Failed to retrieve available firefighters")
-    available = {}
-    for item in data:
-        city = item.get("city") or item.get("name") or "unknown"
-        count = item.get("available", item.get("quantity", 0))
-        available[city] = count
-    return available
+    return availability_counts(data)
 
 def get_available_police():
     data = call_api("/police/search")
     if not data:
         raise RuntimeError("Failed to retrieve available police vehicles")
-    available = {}
-    for item in data:
-        city = item.get("city") or item.get("name") or "unknown"
-        count = item.get("available", item.get("quantity", 0))
-        available[city] = count
-    return available
-
-def dispatch_ambulances(source_city, target_city, count, location_details):
-    source_detail = location_details.get(source_city)
-    target_detail = location_details.get(target_city)
-    if source_detail is None or target_detail is None:
-        print("Error: Missing location details for ambulance dispatch.")
-        return None
-    payload = {
-        "sourceCounty": source_detail.get("county"),
-        "sourceCity": source_detail.get("city"),
-        "targetCounty": target_detail.get("county"),
-        "targetCity": target_detail.get("city"),
-        "quantity": count
-    }
-    result = call_api("/medical/dispatch", method="POST", payload=payload)
-    if result is None:
-        print(f"Dispatch error: Unable to dispatch {count} ambulance(s) from {source_city} to {target_city}.")
-    else:
-        print(f"Dispatched {count} ambulance(s) from {source_city} to {target_city}.")
-    return result
+    return availability_counts(data)
 
-def dispatch_firefighters(source_city, target_city, count, location_details):
-    source_detail = location_details.get(source_city)
-    target_detail = location_details.get(target_city)
-    if source_detail is None or target_detail is None:
-        print("Error: Missing location details for firefighter dispatch.")
-        return None
-    payload = {
-        "sourceCounty": source_detail.get("county"),
-        "sourceCity": source_detail.get("city"),
-        "targetCounty": target_detail.get("county"),
-        "targetCity": target_detail.get("city"),
-        "quantity": count
-    }
-    result = call_api("/fire/dispatch", method="POST", payload=payload)
-    if result is None:
-        print(f"Dispatch error: Unable to dispatch {count} firefighter unit(s) from {source_city} to {target_city}.")
-    else:
-        print(f"Dispatched {count} firefighter unit(s) from {source_city} to {target_city}.")
-    return result
+# Re-fetches a single service's availability when its snapshot goes stale
+AVAILABILITY_FETCHERS = {
+    "Medical": get_available_ambulances,
+    "Fire": get_available_firefighters,
+    "Police": get_available_police
+}
+
+# Returns every service's availability in one response. Only enable AGGREGATE_SEARCH
+# for an emulator that serves it; it is never probed
+AGGREGATE_SEARCH_ENDPOINT = "/resources/search"
+AGGREGATE_SEARCH = False
 
-def dispatch_police(source_city, target_city, count, location_details):
-    source_detail = location_details.get(source_city)
-    target_detail = location_details.get(target_city)
-    if source_detail is None or target_detail is None:
-        print("Error: Missing location details for police dispatch.")
+def get_available_resources():
+    """
+    Fetch one availability snapshot for every service type, from the aggregate
+    endpoint with AGGREGATE_SEARCH, else (or if its response lacks a list for
+    some service) with one search per service.
+    """
+    if AGGREGATE_SEARCH:
+        data = call_api(AGGREGATE_SEARCH_ENDPOINT)
+        if isinstance(data, dict) and all(
+            isinstance(data.get(service_type.lower()), list) for service_type in AVAILABILITY_FETCHERS
+        ):
+            return {
+                service_type: availability_counts(data[service_type.lower()])
+                for service_type in AVAILABILITY_FETCHERS
+            }
+        log.warning("Unexpected aggregate search response; falling back to per-service searches.")
+    return {service_type: fetch() for service_type, fetch in AVAILABILITY_FETCHERS.items()}
+
+# Dispatch endpoint and logged unit name for each service type
+DISPATCH_ENDPOINTS = {"Medical": "/medical/dispatch", "Fire": "/fire/dispatch", "Police": "/police/dispatch"}
+DISPATCH_UNITS = {"Medical": "ambulance(s)", "Fire": "firefighter unit(s)", "Police": "police unit(s)"}
+
+def dispatch(service_type, source_city, target_city, count):
+    if source_city not in source_templates or target_city not in target_templates:
+        log.error("Error: Missing location details for %s dispatch.", service_type)
         return None
-    payload = {
-        "sourceCounty": source_detail.get("county"),
-        "sourceCity": source_detail.get("city"),
-        "targetCounty": target_detail.get("county"),
-        "targetCity": target_detail.get("city"),
-        "quantity": count
-    }
-    result = call_api("/police/dispatch", method="POST", payload=payload)
+    payload = {**source_templates[source_city], **target_templates[target_city], "quantity": count}
+    result = call_api(DISPATCH_ENDPOINTS[service_type], method="POST", payload=payload)
+    units = DISPATCH_UNITS[service_type]
     if result is None:
-        print(f"Dispatch error: Unable to dispatch {count} police unit(s) from {source_city} to {target_city}.")
+        log.error("Dispatch error: Unable to dispatch %s %s from %s to %s.", count, units, source_city, target_city)
     else:
-        print(f"Dispatched {count} police unit(s) from {source_city} to {target_city}.")
+        log.debug("Dispatched %s %s from %s to %s.", count, units, source_city, target_city)
     return result
 
-def process_multi_service_emergency(call, location_details):
+def process_multi_service_emergency(call, location_details, available_resources):
     """
     Process an emergency call that may request multiple service types.
-    It expects "city" and a "requests" array in the call.
+    It expects "city" and a "requests" array in the call, and dispatches from
+    the shared 'available_resources' snapshot, decrementing it as it goes.
     """
     target_city = call.get("city")
     if not target_city:
-        print("Error: Emergency call missing 'city' field.")
+        log.error("Error: Emergency call missing 'city' field.")
         return False
 
     requests_list = call.get("requests", [])
     if not requests_list:
-        print("Error: No service requests provided in the call.")
+        log.error("Error: No service requests provided in the call.")
         return False
 
-    # Build a dictionary of available resources for each service type
-    available_resources = {
-        "Medical": get_available_ambulances(),
-        "Fire": get_available_firefighters(),
-        "Police": get_available_police()
-    }
-
     all_success = True  # Track if all dispatches were fulfilled
 
     for req in requests_list:
         service_type = req.get("Type")
         quantity_needed = req.get("Quantity", 0)
         if quantity_needed <= 0:
-            print(f"Skipping service '{service_type}' with non-positive quantity {quantity_needed}.")
+            log.debug("Skipping service '%s' with non-positive quantity %s.", service_type, quantity_needed)
             continue
 
-        print(f"\nEmergency call: {quantity_needed} unit(s) of {service_type} required at {target_city}.")
+        log.debug("Emergency call: %s unit(s) of %s required at %s.", quantity_needed, service_type, target_city)
         if target_city not in location_details:
-            print(f"Error: Target city '{target_city}' not found in location details.")
+            log.error("Error: Target city '%s' not found in location details.", target_city)
             continue
 
-        target_coord = (location_details[target_city]["latitude"], location_details[target_city]["longitude"])
         available = available_resources.get(service_type)
         if available is None:
-            print(f"Error: Unknown service type '{service_type}'.")
+            log.error("Error: Unknown service type '%s'.", service_type)
             continue
 
-        # Gather candidate cities with available units, sorted by Euclidean distance
-        candidates = []
-        for city, count in available.items():
-            if count > 0 and city in location_details:
-                source_detail = location_details[city]
-                source_coord = (source_detail["latitude"], source_detail["longitude"])
-                distance = euclidean_distance(source_coord, target_coord)
-                candidates.append((city, distance, count))
-        candidates.sort(key=lambda candidate: candidate[1])
-
-        remaining = quantity_needed
-        for city, distance, avail_count in candidates:
-            if remaining <= 0:
-                break
-            dispatch_count = min(avail_count, remaining)
-            if service_type == "Medical":
-                dispatch_ambulances(city, target_city, dispatch_count, location_details)
-            elif service_type == "Fire":
-                dispatch_firefighters(city, target_city, dispatch_count, location_details)
-            elif service_type == "Police":
-                dispatch_police(city, target_city, dispatch_count, location_details)
-            else:
-                print(f"Unknown service type: {service_type}")
-                continue
-            available[city] -= dispatch_count
-            remaining -= dispatch_count
+        src_idx, take = nearest_sources(available, target_city, quantity_needed)
+        remaining = quantity_needed - int(take.sum())
+        stale = False
+        for i, dispatch_count in zip(src_idx.tolist(), take.tolist()):
+            if dispatch(service_type, city_list[i], target_city, dispatch_count) is None:
+                stale = True
+
+        if stale:
+            # A rejected dispatch means the snapshot no longer matches the server
+            available_resources[service_type] = AVAILABILITY_FETCHERS[service_type]()
 
         if remaining > 0:
-            print(f"Warning: Unable to dispatch {remaining} unit(s) of {service_type} for {target_city}!")
+            log.warning("Warning: Unable to dispatch %s unit(s) of %s for %s!", remaining, service_type, target_city)
             all_success = False
         else:
-            print(f"Emergency resolved: all required {service_type} units dispatched successfully.")
+            log.debug("Emergency resolved: all required %s units dispatched successfully.", service_type)
 
     return all_success
 
@@ -238,13 +272,26 @@ def get_pending_calls():
     """
     Retrieve emergencies from the /calls/queue endpoint.
     We assume the API returns a list, and you could also pass a limit parameter.
+    The request is conditional on queue_etag, so an unchanged queue costs no body.
     """
+    global queue_etag, queue_calls
     # Optionally, you can pass a limit param if your API supports it:
     params = {"limit": SIMULATION_CONFIG["maxActiveCalls"]}
-    data = call_api("/calls/queue", params=params)
-    if not data or (isinstance(data, str) and data.strip() == ""):
+    headers = {"If-None-Match": queue_etag} if queue_etag else None
+    try:
+        response = session.get(URLS["/calls/queue"], params=params, headers=headers)
+        if response.status_code == 304:
+            return queue_calls
+        response.raise_for_status()
+    except requests.RequestException as e:
+        log.error("Error during API call to /calls/queue: %s", e)
         return []
-    return data
+    try:
+        data = orjson.loads(response.content) if response.content.strip() else []
+    except orjson.JSONDecodeError:
+        data = []
+    queue_etag, queue_calls = response.headers.get("ETag"), data if isinstance(data, list) else []
+    return queue_calls
 
 def request_next_call():
     """
@@ -257,24 +304,24 @@ def request_next_call():
     return data
 
 def main():
-    print("Starting emergency service simulation...")
+    log.info("Starting emergency service simulation...")
 
     # Reset the simulation.
     reset_result = call_api("/control/reset", method="POST", params=SIMULATION_CONFIG)
     if reset_result is None:
-        print("Failed to reset simulation.")
+        log.error("Failed to reset simulation.")
         return
-    print("Simulation reset successful. Configuration:")
-    print(SIMULATION_CONFIG)
+    log.info("Simulation reset successful. Configuration: %s", SIMULATION_CONFIG)
 
-    print("\nFetching locations...")
+    log.info("Fetching locations...")
     try:
         location_details = get_location_details()
     except Exception as e:
-        print("Error getting location details:", e)
+        log.error("Error getting location details: %s", e)
         return
 
-    print(f"Retrieved {len(location_details)} locations.")
+    build_city_index(location_details)
+    log.info("Retrieved %s locations.", len(location_details))
 
     total_calls_processed = 0
     consecutive_empty_calls = 0
@@ -284,11 +331,13 @@ def main():
         pending_calls = get_pending_calls()
         if pending_calls:
             consecutive_empty_calls = 0
-            print(f"Processing batch of {len(pending_calls)} call(s)...")
+            log.info("Processing batch of %s call(s)...", len(pending_calls))
+            # One snapshot per batch, kept current by local decrements
+            available_resources = get_available_resources()
             for call in pending_calls:
                 if isinstance(call, str) and call.strip() == "":
                     continue
-                success = process_multi_service_emergency(call, location_details)
+                success = process_multi_service_emergency(call, location_details, available_resources)
                 if success:
                     total_calls_processed += 1
                 if total_calls_processed >= SIMULATION_CONFIG["targetDispatches"]:
@@ -298,20 +347,40 @@ def main():
             next_call = request_next_call()
             if not next_call:
                 consecutive_empty_calls += 1
-                print("Queue is empty, requesting next call... "
-                      f"(consecutive empty calls: {consecutive_empty_calls})")
+                log.info("Queue is empty, requesting next call... "
+                         "(consecutive empty calls: %s)", consecutive_empty_calls)
                 if consecutive_empty_calls >= MAX_CONSECUTIVE_EMPTY_CALLS:
-                    print("No further calls available; stopping simulation.")
+                    log.info("No further calls available; stopping simulation.")
                     break
             else:
                 consecutive_empty_calls = 0
         time.sleep(1)
 
-    print("\nAll emergencies processed or no further calls available. Stopping simulation...")
+    log.info("All emergencies processed or no further calls available. Stopping simulation...")
     stop_result = call_api("/control/stop", method="POST")
     print("\nSimulation finished. Final results:")
     print(stop_result)
     print(f"Total emergency calls processed: {total_calls_processed}")
 
+def start_logging():
+    """
+    Route log records through a queue to a background listener writing to stderr,
+    so the processing loop never blocks on the stream.
+    """
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    # Per-dispatch progress is logged at DEBUG
+    root.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
 if __name__ == '__main__':
-    main()
+    listener = start_logging()
+    try:
+        main()
+    finally:
+        listener.stop()
@@ -1,11 +1,24 @@
 #!/usr/bin/env python3
-import math
 import time
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
+import numpy as np
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = "http://localhost:5000"
+# Request bodies are pre-encoded with orjson and sent with this header
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Full URL of every fixed endpoint, so call_api does not rebuild it per request
+URLS = {
+    endpoint: BASE_URL + endpoint
+    for endpoint in (
+        "/locations", "/calls/queue", "/calls/next", "/control/reset", "/control/stop", "/resources/search",
+        "/medical/search", "/fire/search", "/police/search",
+        "/medical/dispatch", "/fire/dispatch", "/police/dispatch"
+    )
+}
 
 SIMULATION_CONFIG = {
     "seed": "default",
@@ -14,27 +27,56 @@ SIMULATION_CONFIG = {
 }
 
 MAX_CONSECUTIVE_EMPTY_CALLS = 1
+SERVICES = ["Medical", "Fire", "Police"]
+SEARCH_ENDPOINTS = {service: f"/{service.lower()}/search" for service in SERVICES}
+DISPATCH_ENDPOINTS = {service: f"/{service.lower()}/dispatch" for service in SERVICES}
+AGGREGATE_SEARCH_ENDPOINT = "/resources/search"
+AGGREGATE_SEARCH = False  # only for an emulator that serves the aggregate endpoint; never probed
+
+# Long-lived pool for the concurrent availability searches and dispatch flushes
+executor = ThreadPoolExecutor(max_workers=8)
+
+# City names and their positions in every per-city array, built once by build_city_index()
+city_list = []
+city_index = {}
+# nearest_order[i] lists every city index sorted by distance from city i, nearest first
+nearest_order = np.empty((0, 0), dtype=np.int32)
+# Fixed halves of every dispatch payload, per city, built once by build_city_index()
+source_templates = {}
+target_templates = {}
+
+# ETag and parsed calls of the last /calls/queue response; an unchanged queue
+# answers If-None-Match with an empty 304 and the cached calls are reused
+queue_etag = None
+queue_calls = []
+
+
+# Shared session so every call reuses pooled keep-alive connections
+session = requests.Session()
+# Pool sized for the concurrent workers; no automatic retries, a retried POST could dispatch twice
+adapter = HTTPAdapter(pool_connections=64, pool_maxsize=256)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+session.headers["Connection"] = "keep-alive"
 
 
 def call_api(endpoint, method="GET", payload=None, params=None):
-    url = f"{BASE_URL}{endpoint}"
+    url = URLS.get(endpoint) or BASE_URL + endpoint
     try:
         if method.upper() == "GET":
-            response = requests.get(url, params=params)
+            response = session.get(url, params=params)
         elif method.upper() == "POST":
-            response = requests.post(url, json=payload, params=params)
+            data = orjson.dumps(payload) if payload is not None else None
+            headers = JSON_HEADERS if data is not None else None
+            response = session.post(url, data=data, params=params, headers=headers)
         else:
             raise ValueError("Unsupported HTTP method")
         response.raise_for_status()
-        return response.json() if response.text.strip() else ""
-    except requests.RequestException:
+        return orjson.loads(response.content) if response.content.strip() else ""
+    except (requests.RequestException, orjson.JSONDecodeError):
         return None
 
 
-def euclidean_distance(coord1, coord2):
-    return math.hypot(coord1[0] - coord2[0], coord1[1] - coord2[1])
-
-
 def get_location_details():
     data = call_api("/locations")
     locations = {
@@ -50,31 +92,73 @@ def get_location_details():
     return locations
 
 
+def build_city_index(location_details):
+    global city_list, city_index, nearest_order, source_templates, target_templates
+    city_list = list(location_details)
+    city_index = {city: i for i, city in enumerate(city_list)}
+    lats = np.array([location_details[city]["latitude"] for city in city_list], dtype=np.float32)
+    lons = np.array([location_details[city]["longitude"] for city in city_list], dtype=np.float32)
+    dx = lats[:, None] - lats[None, :]
+    dy = lons[:, None] - lons[None, :]
+    # Squared distance ranks the same as distance
+    nearest_order = np.argsort(dx * dx + dy * dy, axis=1, kind="stable").astype(np.int32)
+    source_templates = {city: {"sourceCounty": d["county"], "sourceCity": city} for city, d in location_details.items()}
+    target_templates = {city: {"targetCounty": d["county"], "targetCity": city} for city, d in location_details.items()}
+
+
+def nearest_sources(counts, target_city, qty):
+    # Greedily take up to `qty` units out of `counts` from the nearest cities first;
+    # each city with units holds at least one, so the nearest `qty` of them suffice
+    order = nearest_order[city_index[target_city]]
+    src_idx = order[counts[order] > 0][:qty]
+    cs = np.cumsum(counts[src_idx])
+    # The first prefix whose units cover the request, or every candidate if none does
+    cutoff = min(int(np.searchsorted(cs, qty)) + 1, len(cs))
+    src_idx = src_idx[:cutoff]
+    take = counts[src_idx]
+    if cutoff:
+        take[-1] -= max(int(cs[cutoff - 1]) - qty, 0)
+    counts[src_idx] -= take
+    return src_idx, take
+
+
+def availability_counts(data):
+    counts = np.zeros(len(city_list), dtype=np.int32)
+    for item in data or []:
+        i = city_index.get(item.get("city") or item.get("name"))
+        if i is not None:
+            counts[i] = item.get("available", item.get("quantity", 0))
+    return counts
+
+
 def get_available(service):
-    endpoint = f"/{service}/search"
-    data = call_api(endpoint)
-    return {
-        item.get("city") or item.get("name") or "unknown": item.get("available", item.get("quantity", 0))
-        for item in data or []
-    }
+    return availability_counts(call_api(SEARCH_ENDPOINTS[service]))
+
+
+def get_available_resources():
+    # One aggregate request with AGGREGATE_SEARCH, else (or if a service's list is missing) one search per service
+    if AGGREGATE_SEARCH:
+        data = call_api(AGGREGATE_SEARCH_ENDPOINT)
+        if isinstance(data, dict) and all(isinstance(data.get(service.lower()), list) for service in SERVICES):
+            return {service: availability_counts(data[service.lower()]) for service in SERVICES}
+    futures = {service: executor.submit(get_available, service) for service in SERVICES}
+    return {service: f.result() for service, f in futures.items()}
 
 
-def dispatch(service, source_city, target_city, count, location_details):
-    src = location_details.get(source_city)
-    tgt = location_details.get(target_city)
-    if not src or not tgt:
+def dispatch(service, source_city, target_city, count):
+    if source_city not in source_templates or target_city not in target_templates:
         return None
-    payload = {
-        "sourceCounty": src["county"],
-        "sourceCity": src["city"],
-        "targetCounty": tgt["county"],
-        "targetCity": tgt["city"],
-        "quantity": count
-    }
-    return call_api(f"/{service}/dispatch", method="POST", payload=payload)
+    payload = {**source_templates[source_city], **target_templates[target_city], "quantity": count}
+    return call_api(DISPATCH_ENDPOINTS[service], method="POST", payload=payload)
+
 
+def flush_dispatches(pending):
+    # One POST per (service, source, target) carrying the batch's summed quantity
+    list(executor.map(lambda key: dispatch(*key, pending[key]), list(pending)))
+    pending.clear()
 
-def process_call(call, location_details):
+
+def process_call(call, location_details, available_resources, pending):
     target_city = call.get("city")
     if not target_city or target_city not in location_details:
         return False
@@ -83,14 +167,6 @@ def process_call(call, location_details):
     if not requests_list:
         return False
 
-    with ThreadPoolExecutor() as executor:
-        futures = {
-            service: executor.submit(get_available, service.lower())
-            for service in ["medical", "fire", "police"]
-        }
-        available_resources = {k.capitalize(): f.result() for k, f in futures.items()}
-
-    target_coord = (location_details[target_city]["latitude"], location_details[target_city]["longitude"])
     all_success = True
 
     for req in requests_list:
@@ -99,21 +175,11 @@ def process_call(call, location_details):
         if qty <= 0 or service not in available_resources:
             continue
 
-        candidates = [
-            (city, euclidean_distance((location_details[city]["latitude"], location_details[city]["longitude"]), target_coord), count)
-            for city, count in available_resources[service].items()
-            if count > 0 and city in location_details
-        ]
-        candidates.sort(key=lambda c: c[1])
-
-        remaining = qty
-        for city, _, avail in candidates:
-            if remaining <= 0:
-                break
-            dispatch_count = min(avail, remaining)
-            dispatch(service.lower(), city, target_city, dispatch_count, location_details)
-            available_resources[service][city] -= dispatch_count
-            remaining -= dispatch_count
+        available = available_resources[service]
+        src_idx, take = nearest_sources(available, target_city, qty)
+        remaining = qty - int(take.sum())
+        for i, dispatch_count in zip(src_idx.tolist(), take.tolist()):
+            pending[(service, city_list[i], target_city)] += dispatch_count
 
         if remaining > 0:
             all_success = False
@@ -122,7 +188,20 @@ def process_call(call, location_details):
 
 
 def get_pending_calls():
-    return call_api("/calls/queue", params={"limit": SIMULATION_CONFIG["maxActiveCalls"]}) or []
+    global queue_etag, queue_calls
+    headers = {"If-None-Match": queue_etag} if queue_etag else None
+    try:
+        response = session.get(
+            URLS["/calls/queue"], params={"limit": SIMULATION_CONFIG["maxActiveCalls"]}, headers=headers
+        )
+        if response.status_code == 304:
+            return queue_calls
+        response.raise_for_status()
+        data = orjson.loads(response.content) if response.content.strip() else []
+    except (requests.RequestException, orjson.JSONDecodeError):
+        return []
+    queue_etag, queue_calls = response.headers.get("ETag"), data if isinstance(data, list) else []
+    return queue_calls
 
 
 def request_next_call():
@@ -134,6 +213,7 @@ def main():
         return
 
     location_details = get_location_details()
+    build_city_index(location_details)
     total_calls = 0
     empty_count = 0
 
@@ -147,15 +227,22 @@ def main():
                     break
             else:
                 empty_count = 0
-                if process_call(call, location_details):
+                pending = defaultdict(int)
+                if process_call(call, location_details, get_available_resources(), pending):
                     total_calls += 1
+                flush_dispatches(pending)
         else:
             empty_count = 0
+            # One snapshot per batch, kept current by local decrements; the batch's
+            # dispatches are planned against it and sent together at the end
+            available_resources = get_available_resources()
+            pending = defaultdict(int)
             for call in calls:
-                if process_call(call, location_details):
+                if process_call(call, location_details, available_resources, pending):
                     total_calls += 1
                 if total_calls >= SIMULATION_CONFIG["targetDispatches"]:
                     break
+            flush_dispatches(pending)
 
     stop_result = call_api("/control/stop", method="POST")
     print(stop_result)